@@ -0,0 +1,573 @@
+"""
+Shared helpers for generating Legado metadata: land sampling, simulated
+data sources, the metadata template and the output writers.
+"""
+import os
+import re
+import orjson
+from datetime import datetime, timedelta
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+import zipfile
+import functools
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+def format_minted_date(dt):
+    """
+    Format `dt` as the ISO timestamp, API date and image date strings.
+    Equivalent to strftime with "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d" and
+    "%y%m%d", built from one formatting pass.
+    """
+    date_str = f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+    timestamp_str = f"{date_str}T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}Z"
+    image_date_str = date_str[2:4] + date_str[5:7] + date_str[8:10]
+    return timestamp_str, date_str, image_date_str
+
+def download_natural_earth_data():
+    """
+    Uses the local Natural Earth 1:110m Cultural Vectors dataset.
+    Returns the path to the extracted data.
+    """
+    # Create a data directory if it doesn't exist
+    data_dir = "natural_earth_data"
+    os.makedirs(data_dir, exist_ok=True)
+    
+    # Use the local zip file
+    zip_path = "ne_110m_admin_0_countries.zip"
+    
+    # Extract the data
+    try:
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            zip_ref.extractall(data_dir)
+        
+        # Return the path to the shapefile
+        return os.path.join(data_dir, "ne_110m_admin_0_countries.shp")
+    except Exception as e:
+        print(f"Error extracting Natural Earth data: {e}")
+        return None
+
+# Country polygons and their spatial index, loaded once per worker process
+# by `load_land`
+countries = None
+land_tree = None
+
+def load_land(natural_earth_path):
+    """
+    Load the Natural Earth country polygons into this process, prepare them
+    and index them with an STRtree. Used as the worker pool initializer.
+    """
+    global countries, land_tree
+    # Imported here so only worker processes pay for loading geopandas
+    import geopandas as gpd
+    
+    world = gpd.read_file(natural_earth_path, engine="pyogrio")
+    countries = world.geometry.to_numpy()
+    # Prepared once so contains_xy doesn't rebuild a prepared copy per test
+    shapely.prepare(countries)
+    land_tree = STRtree(countries)
+
+# Uniform ranges of the per-token random values, drawn a task at a time
+PER_TOKEN_RANGES = {
+    # World conditions
+    "co2_ppm": (-50, 50),
+    "global_temp": (-0.3, 0.3),
+    "ch4_ppb": (-300, 300),
+    "arctic_ice": (-0.5, 0.5),
+    "sea_level": (-10, 10),
+    # Weather
+    "temperature": (-5, 5),
+    "precip": (-20, 20),
+    # Environmental
+    "elevation": (-500, 500),
+    "elevation_slope": (0, 45),
+    "elevation_aspect": (0, 360),
+    "pm25": (5, 50),
+    "pm10": (10, 100),
+    "no2": (10, 100),
+    "o3": (20, 150),
+    "annual_precipitation": (200, 2000),
+    "annual_temperature": (-20, 30),
+    "humidity": (40, 90),
+    "slope": (0, 45),
+    "aspect": (0, 360),
+    "roughness": (0, 100),
+    # Planetary Computer
+    "ndvi": (0, 1),
+    "land_surface_temperature": (-20, 50),
+    "pc_precipitation": (0, 100),
+    "pc_elevation": (-100, 5000),
+}
+
+# Uniform ranges of the per-hour offsets added to each token's daily
+# weather, drawn as (n, 24) matrices
+HOURLY_OFFSET_RANGES = {
+    "temperature_2m": (-3, 3),
+    "precipitation": (-5, 5),
+}
+
+# Uniform ranges of the per-hour weather values, drawn as (n, 24) matrices
+# and rounded for the whole task at once
+HOURLY_RANGES = {
+    "relative_humidity_2m": (40, 90),
+    "wind_speed_10m": (0, 30),
+    "wind_direction_10m": (0, 360),
+    "cloud_cover": (0, 100),
+    "pressure_msl": (980, 1020),
+}
+
+def draw_random_values(rng, n):
+    """
+    Draw every random value needed for `n` tokens in vectorized NumPy calls.
+    Scalars per token become lists of length `n`; hourly weather values
+    stay (n, 24) arrays and are converted row by row.
+    """
+    draws = {
+        "co2_saved": rng.integers(20, 401, n).tolist(),
+        "deforestation_prevented": rng.integers(0, 56, n).tolist(),
+        "minted_seconds": rng.integers(0, minted_span_seconds + 1, n).tolist(),
+    }
+    for name, (low, high) in PER_TOKEN_RANGES.items():
+        draws[name] = rng.uniform(low, high, n).tolist()
+    for name, (low, high) in HOURLY_OFFSET_RANGES.items():
+        draws[name] = rng.uniform(low, high, (n, 24))
+    for name, (low, high) in HOURLY_RANGES.items():
+        draws[name] = np.round(rng.uniform(low, high, (n, 24)), 1)
+    return draws
+
+# Temperature offset per season (1=Winter, 2=Spring, 3=Summer, 4=Fall)
+SEASON_ADJUSTMENT = {
+    1: -10,  # Winter
+    2: 5,    # Spring
+    3: 15,   # Summer
+    4: 0     # Fall
+}
+
+# "THH:00" suffixes of the 24 hourly timestamps
+HOUR_SUFFIXES = [f"T{hour:02d}:00" for hour in range(24)]
+
+def simulate_weather_data(lat, lon, date_str, draws, k):
+    """
+    Simulate weather data with realistic values based on latitude and season.
+    Random values are taken from row `k` of `draws`.
+    """
+    # Calculate season based on date (`date_str` is always YYYY-MM-DD)
+    month = int(date_str[5:7])
+    season = (month % 12 + 3) // 3  # 1=Winter, 2=Spring, 3=Summer, 4=Fall
+    
+    # Base temperature varies by latitude and season
+    base_temp = 20 - (abs(lat) * 0.5)  # Temperature decreases with latitude
+    temperature = base_temp + SEASON_ADJUSTMENT[season] + draws["temperature"][k]
+    
+    # Precipitation varies by season and latitude
+    base_precip = 50 + (abs(lat) * 0.3)  # More precipitation near equator
+    precip = base_precip + draws["precip"][k]
+    
+    # Generate hourly data, rounding each field across all 24 hours at once
+    temps = np.round(temperature + draws["temperature_2m"][k], 1).tolist()
+    precips = np.round(np.maximum(0, precip + draws["precipitation"][k]), 1).tolist()
+    hourly_data = [
+        {
+            "time": date_str + hour_suffix,
+            "temperature_2m": temp,
+            "precipitation": precip_hour,
+            "relative_humidity_2m": humidity,
+            "wind_speed_10m": wind_speed,
+            "wind_direction_10m": wind_direction,
+            "cloud_cover": cloud_cover,
+            "pressure_msl": pressure
+        }
+        for hour_suffix, temp, precip_hour, humidity, wind_speed, wind_direction, cloud_cover, pressure in zip(
+            HOUR_SUFFIXES,
+            temps,
+            precips,
+            draws["relative_humidity_2m"][k].tolist(),
+            draws["wind_speed_10m"][k].tolist(),
+            draws["wind_direction_10m"][k].tolist(),
+            draws["cloud_cover"][k].tolist(),
+            draws["pressure_msl"][k].tolist(),
+        )
+    ]
+    
+    return {"hourly": hourly_data}
+
+def simulate_environmental_data(lat, lon, date_str, draws, k):
+    """
+    Simulate environmental data with realistic values based on location.
+    Random values are taken from row `k` of `draws`.
+    """
+    # Elevation data (higher near equator and poles)
+    base_elevation = 1000 + (abs(lat) * 50)  # Base elevation increases with latitude
+    elevation = base_elevation + draws["elevation"][k]
+    
+    # Air quality (worse in urban areas, better in remote areas)
+    air_quality = {
+        "pm25": round(draws["pm25"][k], 1),  # PM2.5 in µg/m³
+        "pm10": round(draws["pm10"][k], 1),  # PM10 in µg/m³
+        "no2": round(draws["no2"][k], 1),  # NO2 in µg/m³
+        "o3": round(draws["o3"][k], 1)  # O3 in µg/m³
+    }
+    
+    # Climate data
+    climate_data = {
+        "annual_precipitation": round(draws["annual_precipitation"][k], 1),  # mm/year
+        "annual_temperature": round(draws["annual_temperature"][k], 1),  # °C
+        "humidity": round(draws["humidity"][k], 1)  # %
+    }
+    
+    # Terrain data
+    terrain_data = {
+        "slope": round(draws["slope"][k], 1),  # degrees
+        "aspect": round(draws["aspect"][k], 1),  # degrees
+        "roughness": round(draws["roughness"][k], 1)  # index
+    }
+    
+    return {
+        'elevation_data': {
+            'elevation': round(elevation, 1),
+            'slope': round(draws["elevation_slope"][k], 1),
+            'aspect': round(draws["elevation_aspect"][k], 1)
+        },
+        'air_quality_data': air_quality,
+        'climate_data': climate_data,
+        'terrain_data': terrain_data
+    }
+
+def simulate_planetary_computer_data(lat, lon, date_str, draws, k):
+    """
+    Simulate satellite and environmental data that would come from Planetary Computer.
+    Random values are taken from row `k` of `draws`.
+    """
+    # Generate random but realistic values for various environmental indicators
+    return {
+        "sentinel-2-l2a": f"https://example.com/sentinel2/{date_str.replace('-', '')}_{lat}_{lon}.jpg",
+        "landsat-8-c2-l2": f"https://example.com/landsat8/{date_str.replace('-', '')}_{lat}_{lon}.jpg",
+        "ndvi": round(draws["ndvi"][k], 3),  # Normalized Difference Vegetation Index
+        "land_surface_temperature": round(draws["land_surface_temperature"][k], 1),  # °C
+        "precipitation": round(draws["pc_precipitation"][k], 1),  # mm
+        "elevation": round(draws["pc_elevation"][k], 1)  # meters
+    }
+
+def land_coord_iter(rng, batch=65536):
+    """
+    Yields random (latitude, longitude) pairs that fall on land.
+
+    Candidates are drawn from `rng` `batch` at a time. One STRtree query
+    pairs each point with the few countries whose bounding box contains it,
+    and those pairs are tested with `contains_xy` on the raw coordinates.
+    """
+    while True:
+        # Approximate ranges where most land areas are found
+        lat = rng.uniform(-60, 80, batch)
+        lon = rng.uniform(-180, 180, batch)
+        point_idx, country_idx = land_tree.query(shapely.points(lon, lat))
+        on_land = shapely.contains_xy(countries[country_idx], lon[point_idx], lat[point_idx])
+        mask = np.zeros(batch, dtype=bool)
+        mask[point_idx[on_land]] = True
+        yield from zip(lat[mask].tolist(), lon[mask].tolist())
+
+def simulate_imagery(lat, lon, date_str):
+    """
+    Simulate satellite imagery URL based on coordinates and date.
+    """
+    return f"https://example.com/satellite/{date_str.replace('-', '')}_{lat}_{lon}.jpg"
+
+# Directory where the metadata files will be stored
+output_folder = "metadata_files"
+
+# GeoJSON file collecting one point feature per metadata file
+geojson_path = os.path.join(output_folder, "points.geojson")
+
+# Per-task GeoJSON-Seq shards, named by the task's first serial number and
+# merged into `geojson_path` in serial-number order at the end
+geojson_shard_pattern = os.path.join(output_folder, "points.{start}.geojsonl")
+
+# Number of serial numbers handed to a worker per task
+TASK_SIZE = 10_000
+
+# SQLite database used instead of individual files with `--output sqlite`
+sqlite_path = os.path.join(output_folder, "metadata.sqlite")
+
+# Number of serialized files handed to the writer thread at once
+WRITE_BATCH_SIZE = 512
+
+# Number of rows inserted per SQLite transaction
+SQLITE_BATCH_SIZE = 10_000
+
+# Define the time range for the minted timestamp: from 2024-01-01 to 2025-04-02
+start_date = datetime(2024, 1, 1, 0, 0, 0)
+end_date = datetime(2025, 4, 2, 23, 59, 59)
+minted_span_seconds = int((end_date - start_date).total_seconds())
+
+# Achievements template to include for the first 50 files and occasionally after
+achievements_template = [
+    {
+        "project_name": "Legado Early - Guania Colombia",
+        "description": "Before going sale, Legado has helped communities in the Guania region of Colombia to protect 20,000 hectares of rainforest, preventing deforestation and conserving biodiversity.",
+        "current_status": "Up to 8 communities are now involved in the project, with 100% of the land protected from deforestation.",
+        "region": "Amazon Rainforest, Colombia",
+        "co2_sequestered_estimate_tonnes": 4,
+        "deforestation_prevented_km2": 5
+    },
+    {
+        "project_name": "Legado Early - Africa",
+        "description": "Legado Africa is a project that aims to give access to clean water to 1 million people in Africa by 2030.",
+        "current_status": "The project has already provided clean water to 100,000 people in 2024.",
+        "region": "Africa",
+        "co2_saved_estimate_tonnes": 1,
+        "deforestation_prevented_km2": 1
+    }
+]
+
+# Achievements pre-serialized once and spliced into the template as-is
+ACHIEVEMENTS_JSON = orjson.dumps(achievements_template).decode()
+NO_ACHIEVEMENTS_JSON = "[]"
+
+# Data sources credited in every metadata file, shared by reference
+DATA_SOURCES = [
+    {
+        "name": "NASA GISS",
+        "url": "https://data.giss.nasa.gov/"
+    },
+    {
+        "name": "NOAA Climate Data",
+        "url": "https://www.ncdc.noaa.gov/"
+    },
+    {
+        "name": "Microsoft Planetary Computer",
+        "url": "https://planetarycomputer.microsoft.com/"
+    },
+    {
+        "name": "Open-Meteo",
+        "url": "https://open-meteo.com/"
+    }
+]
+
+# Metadata layout with "@@name@@" sentinels marking the per-token values
+METADATA_SKELETON = {
+    "attributes": [
+        {
+            "trait_type": "CO2 Saved (tonnes)",
+            "value": "@@co2_saved@@"
+        },
+        {
+            "trait_type": "Deforestation Prevented (km^2)",
+            "value": "@@deforestation_prevented@@"
+        }
+    ],
+    "metadata_version": "1.0",
+    "token_details": {
+        "timestamp_minted": "@@minted_date_str@@",
+        "serial_number": "@@serial_number@@",
+        "coordinates": {
+            "latitude": "@@lat@@",
+            "longitude": "@@lon@@"
+        },
+        "world_conditions_on_mint": {
+            "co2_ppm": "@@co2_ppm@@",
+            "global_temperature_anomaly_c": "@@global_temp@@",
+            "ch4_ppb": "@@ch4_ppb@@",
+            "arctic_sea_ice_min_extent_million_km2": "@@arctic_ice@@",
+            "ice_sheets_status": "Net Mass Loss",
+            "sea_level_mm_above_ref": "@@sea_level@@",
+            "ocean_warming_status": "Elevated",
+            "nasa_image": "https://apod.nasa.gov/apod/calendar/S_@@minted_date_for_image@@.jpg",
+            "planetary_image": "@@planetary_image@@",
+            "weather_data": "@@weather_data@@",
+            "environmental_data": "@@environmental_data@@",
+            "planetary_computer_data": "@@planetary_computer_data@@",
+        },
+        "achievements": "@@achievements@@",
+        "data_sources": DATA_SOURCES,
+        "future_updates": {}
+    }
+}
+
+# GeoJSON feature layout written to the worker's GeoJSON-Seq shard
+FEATURE_SKELETON = {
+    "type": "Feature",
+    "properties": {
+        "id": "@@feature_id@@",
+        "name": "Legado Point @@feature_id@@",
+        "co2_saved": "@@co2_saved@@",
+        "deforestation_prevented": "@@deforestation_prevented@@",
+        "minted_date": "@@minted_date_str@@"
+    },
+    "geometry": {
+        "type": "Point",
+        "coordinates": ["@@lon@@", "@@lat@@"]
+    }
+}
+
+# Sentinels whose value is spliced into a JSON string rather than replacing it
+TEMPLATE_STRING_FIELDS = ("feature_id", "minted_date_str", "minted_date_for_image", "planetary_image")
+
+def build_metadata_template(skeleton):
+    """
+    Serialize `skeleton` once as compact JSON and turn it into a
+    `str.format` template with one field per sentinel.
+    """
+    text = orjson.dumps(skeleton).decode()
+    text = text.replace("{", "{{").replace("}", "}}")
+    for name in TEMPLATE_STRING_FIELDS:
+        text = text.replace(f"@@{name}@@", f"{{{name}}}")
+    return re.sub(r'"@@(\w+)@@"', r"{\1}", text)
+
+METADATA_TEMPLATE = build_metadata_template(METADATA_SKELETON)
+FEATURE_TEMPLATE = build_metadata_template(FEATURE_SKELETON) + "\n"
+
+def write_metadata_files(pending):
+    """
+    Write a batch of (serial_number, serialized metadata) pairs to disk.
+    """
+    for i, data in pending:
+        file_path = os.path.join(output_folder, f"{i}.txt")
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # os.write may write less than asked; loop until all of it is out
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+def connect_metadata_db():
+    """
+    Open the packed metadata database, creating its table if needed.
+    """
+    # The writer thread uses the connection, never concurrently with its creator
+    conn = sqlite3.connect(sqlite_path, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (id INTEGER PRIMARY KEY, json BLOB)")
+    return conn
+
+def write_metadata_rows(conn, pending):
+    """
+    Insert a batch of (serial_number, serialized metadata) pairs in one transaction.
+    """
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO metadata (id, json) VALUES (?, ?)", pending)
+
+def generate_metadata_batch(start_idx, end_idx, output="files"):
+    """
+    Generate a batch of metadata files in parallel.
+    
+    With `output="sqlite"` the metadata is stored as rows of a single SQLite
+    database rather than one file per serial number. GeoJSON features are
+    written to this task's shard; returns the number of tokens generated.
+    """
+    batch_geojson_features = []
+    
+    # Seeded per task so forked workers don't share a random stream; SFC64 is
+    # NumPy's fastest bit generator
+    rng = np.random.Generator(np.random.SFC64())
+    n = end_idx - start_idx + 1
+    draws = draw_random_values(rng, n)
+    coords = land_coord_iter(rng)
+    
+    # Serial numbers that carry achievements: the first 50, then ~1% at random
+    achievement_ids = set(range(start_idx, min(end_idx, 50) + 1))
+    achievement_ids.update((start_idx + np.flatnonzero(rng.random(n) < 0.01)).tolist())
+    
+    if output == "sqlite":
+        conn = connect_metadata_db()
+        write_batch = functools.partial(write_metadata_rows, conn)
+        flush_size = SQLITE_BATCH_SIZE
+    else:
+        conn = None
+        write_batch = write_metadata_files
+        flush_size = WRITE_BATCH_SIZE
+    
+    # One writer thread overlaps file syscalls (which release the GIL) with
+    # building the next batch; at most one batch is in flight at a time
+    writer = ThreadPoolExecutor(max_workers=1)
+    in_flight = None
+    pending = []
+    
+    for k, i in enumerate(range(start_idx, end_idx + 1)):
+        # Generate random attribute values
+        co2_saved = draws["co2_saved"][k]
+        deforestation_prevented = draws["deforestation_prevented"][k]
+        
+        # Generate a random minted timestamp within the specified range
+        minted_datetime = start_date + timedelta(seconds=draws["minted_seconds"][k])
+        minted_date_str, minted_date_for_api, minted_date_for_image = format_minted_date(minted_datetime)
+        
+        # Generate random world conditions
+        co2_ppm = round(420.5 + draws["co2_ppm"][k], 2)
+        global_temp = round(1.24 + draws["global_temp"][k], 2)
+        ch4_ppb = round(1895 + draws["ch4_ppb"][k], 2)
+        arctic_ice = round(3.9 + draws["arctic_ice"][k], 2)
+        sea_level = round(95 + draws["sea_level"][k], 2)
+        
+        # Determine achievements
+        achievements = ACHIEVEMENTS_JSON if i in achievement_ids else NO_ACHIEVEMENTS_JSON
+        
+        # Get random land coordinates
+        lat, lon = next(coords)
+        
+        # Add to batch GeoJSON features
+        batch_geojson_features.append(FEATURE_TEMPLATE.format(
+            feature_id=i,
+            co2_saved=co2_saved,
+            deforestation_prevented=deforestation_prevented,
+            minted_date_str=minted_date_str,
+            lat=lat,
+            lon=lon,
+        ).encode())
+        
+        # Simulate data
+        weather_data = simulate_weather_data(lat, lon, minted_date_for_api, draws, k)
+        environmental_data = simulate_environmental_data(lat, lon, minted_date_for_api, draws, k)
+        planetary_computer_data = simulate_planetary_computer_data(lat, lon, minted_date_for_api, draws, k)
+        planetary_image = simulate_imagery(lat, lon, minted_date_for_api)
+        
+        # Render metadata from the pre-built template
+        metadata = METADATA_TEMPLATE.format(
+            co2_saved=co2_saved,
+            deforestation_prevented=deforestation_prevented,
+            minted_date_str=minted_date_str,
+            serial_number=i,
+            lat=lat,
+            lon=lon,
+            co2_ppm=co2_ppm,
+            global_temp=global_temp,
+            ch4_ppb=ch4_ppb,
+            arctic_ice=arctic_ice,
+            sea_level=sea_level,
+            minted_date_for_image=minted_date_for_image,
+            planetary_image=planetary_image,
+            weather_data=orjson.dumps(weather_data).decode(),
+            environmental_data=orjson.dumps(environmental_data).decode(),
+            planetary_computer_data=orjson.dumps(planetary_computer_data).decode(),
+            achievements=achievements,
+        )
+        
+        # Queue serialized metadata; full batches are written in the background
+        pending.append((i, metadata.encode()))
+        if len(pending) >= flush_size:
+            if in_flight is not None:
+                in_flight.result()
+            in_flight = writer.submit(write_batch, pending)
+            pending = []
+    
+    if in_flight is not None:
+        in_flight.result()
+    write_batch(pending)
+    writer.shutdown()
+    if conn is not None:
+        conn.close()
+    
+    shard_path = geojson_shard_pattern.format(start=start_idx)
+    with open(shard_path, "wb") as f:
+        f.write(b"".join(batch_geojson_features))
+    
+    return len(batch_geojson_features)
+
+def generate_metadata_task(task):
+    """
+    Unpack a (start_idx, end_idx, output) task for use with `Pool.imap_unordered`.
+    """
+    return generate_metadata_batch(*task)
@@ -1,116 +1,533 @@
 import os
-import json
+import numpy as np
+import orjson
+import simdjson
+import itertools
+import mmap
 import multiprocessing
+import threading
+import argparse
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from tqdm import tqdm
 
+# Per-worker state set up by `init_worker`: the simdjson parser reused for
+# every file, the manifest connection, the optional zstd compressor and
+# the read-ahead pool. Thread-local so that worker threads (`--io-bound`)
+# each get their own, like worker processes do.
+worker_state = threading.local()
+
+def connect_manifest(manifest_path):
+    """
+    Open the manifest recording the mtime, size and minified schema version
+    of every file written by a previous run, creating its table if needed.
+    """
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS minified (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, schema INTEGER)"
+    )
+    # Manifests from before the schema column get it as NULL, so none of
+    # their rows match the current version and those files are redone
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(minified)")]
+    if "schema" not in columns:
+        with conn:
+            conn.execute("ALTER TABLE minified ADD COLUMN schema INTEGER")
+    return conn
+
+def init_worker(manifest_path, compress=False, read_ahead=True):
+    """
+    Create this worker's simdjson parser once, so its internal buffers are
+    reused across every file the worker handles, and open the manifest.
+    With `compress`, also create the worker's zstd compressor; with
+    `read_ahead`, the thread pool that reads files ahead of the parser.
+    """
+    worker_state.parser = simdjson.Parser()
+    worker_state.manifest = connect_manifest(manifest_path)
+    worker_state.read_pool = ThreadPoolExecutor(max_workers=READ_AHEAD) if read_ahead else None
+    worker_state.compressor = None
+    if compress:
+        # Only needed for --zstd
+        import zstandard
+        worker_state.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+
+# Upper bound on the number of files handed to a worker at once
+MAX_BATCH_SIZE = 64
+
+# Batches queued per worker at any time; more are submitted as earlier
+# ones finish, so the file list is never drained into pending futures
+BATCHES_IN_FLIGHT = 4
+
+# Number of finished files accumulated before updating the progress bar
+PROGRESS_CHUNK = 128
+
+# Files at least this large are memory-mapped rather than read into memory
+MMAP_THRESHOLD = 64 * 1024
+
+# Number of files each worker reads ahead of the one being processed
+READ_AHEAD = 8
+
+# zstd level for --zstd; level 3 compresses far faster than the JSON parse
+ZSTD_LEVEL = 3
+
+# Version of the minified schema, written first as "v". Bump it whenever
+# the layout changes, so files minified in an older layout are rewritten
+# rather than skipped:
+#   2  hourly weather stored column-wise under "t"."w"."wd"; the input's
+#      metadata_version is kept as "mv". Keys holding their default value
+#      are omitted, and readers treat an absent key as its default:
+#        "a"        attributes    -> []
+#        "t"."ac"   achievements  -> []
+# Files minified before the schema was versioned carry the input's
+# metadata_version string ("1.0") as "v" instead.
+MINIFIED_SCHEMA_VERSION = 2
+
+# Every file in the current minified schema starts with these bytes
+OPTIMIZED_PREFIX = b'{"v":%d,' % MINIFIED_SCHEMA_VERSION
+
+# Hourly weather fields, in the order they are rounded and emitted
+HOURLY_FIELDS = (
+    "temperature_2m",
+    "precipitation",
+    "relative_humidity_2m",
+    "wind_speed_10m",
+    "wind_direction_10m",
+    "cloud_cover",
+    "pressure_msl",
+)
+
+# Keys of the hourly weather columns, in HOURLY_FIELDS order
+HOURLY_KEYS = ("te", "p", "h", "ws", "wd", "cc", "pr")
+
+def quantize_1dp(values):
+    """
+    Round an array to one decimal place via integer scaling, skipping the
+    generic-decimals dispatch inside `np.round` (same results).
+    """
+    return np.rint(values * 10.0) / 10.0
+
+def hourly_columns(values):
+    """
+    Round a (fields, hours) array of hourly weather to one decimal and
+    return it as C-contiguous float32 rows, one per field.
+    """
+    # None becomes NaN in the array; fail the file as round() used to on a
+    # null hourly value rather than writing it back as null
+    if not np.isfinite(values).all():
+        raise ValueError("non-numeric hourly weather value")
+    # float32 columns are serialized natively by orjson (OPT_SERIALIZE_NUMPY)
+    # with the same one-decimal text, without building Python float lists
+    return np.ascontiguousarray(quantize_1dp(values), dtype=np.float32)
+
+def build_hourly(times, te, p, h, ws, wd, cc, pr):
+    """
+    Build the optimized hourly weather from the time strings and the
+    already-rounded value columns, one array per field. The result is laid
+    out column-wise: one parallel list per key, indexed by hour.
+    """
+    return {
+        "t": times,  # time
+        "te": te,  # temperature
+        "p": p,  # precipitation
+        "h": h,  # humidity
+        "ws": ws,  # wind speed
+        "wd": wd,  # wind direction
+        "cc": cc,  # cloud cover
+        "pr": pr  # pressure
+    }
+
 def optimize_metadata(data):
     """
     Optimize the metadata structure to reduce file size.
+    
+    `data` is a lazily parsed simdjson document: only the fields copied into
+    the optimized structure are ever converted to Python objects.
+    
+    Hourly weather is stored column-wise under "wd": {"t": [...], "te": [...],
+    ...} with one list per field; hour `i` is element `i` of every list.
+    
+    The output follows minified schema MINIFIED_SCHEMA_VERSION, written as
+    "v"; keys holding their default value are omitted as described there.
     """
-    # Create optimized structure
+    # Bind the nested objects once; every lookup on a simdjson object is a
+    # key search in the parsed document
+    _round = round
+    td = data["token_details"]
+    wc = td["world_conditions_on_mint"]
+    co = td["coordinates"]
+    hrs = wc["weather_data"]["hourly"]
+    
+    # Quantize the hourly weather as one (hours, fields) array
+    times = []
+    values = []
+    for h in hrs:
+        times.append(h["time"])
+        values.extend(h[field] for field in HOURLY_FIELDS)
+    columns = hourly_columns(np.array(values, dtype=np.float64).reshape(-1, len(HOURLY_FIELDS)).T)
+    
+    # Create optimized structure; "a" (attributes) is always empty here and
+    # is left out, see the schema defaults
     optimized = {
-        "a": [],  # attributes
-        "v": data["metadata_version"],  # version
+        "v": MINIFIED_SCHEMA_VERSION,  # minified schema version
+        "mv": data["metadata_version"],  # metadata version
         "t": {  # token details
-            "ts": data["token_details"]["timestamp_minted"],  # timestamp
-            "sn": data["token_details"]["serial_number"],  # serial number
+            "ts": td["timestamp_minted"],  # timestamp
+            "sn": td["serial_number"],  # serial number
             "c": {  # coordinates
-                "la": data["token_details"]["coordinates"]["latitude"],  # latitude
-                "lo": data["token_details"]["coordinates"]["longitude"]  # longitude
+                "la": co["latitude"],  # latitude
+                "lo": co["longitude"]  # longitude
             },
             "w": {  # world conditions
-                "cp": round(data["token_details"]["world_conditions_on_mint"]["co2_ppm"], 1),  # co2_ppm
-                "gt": round(data["token_details"]["world_conditions_on_mint"]["global_temperature_anomaly_c"], 1),  # global temp
-                "ch": round(data["token_details"]["world_conditions_on_mint"]["ch4_ppb"], 1),  # ch4_ppb
-                "ai": round(data["token_details"]["world_conditions_on_mint"]["arctic_sea_ice_min_extent_million_km2"], 1),  # arctic ice
-                "sl": round(data["token_details"]["world_conditions_on_mint"]["sea_level_mm_above_ref"], 1),  # sea level
-                "ni": data["token_details"]["world_conditions_on_mint"]["nasa_image"],  # nasa image
-                "pi": data["token_details"]["world_conditions_on_mint"]["planetary_image"],  # planetary image
-                "wd": {  # weather data
-                    "h": [  # hourly
-                        {
-                            "t": h["time"],  # time
-                            "te": round(h["temperature_2m"], 1),  # temperature
-                            "p": round(h["precipitation"], 1),  # precipitation
-                            "h": round(h["relative_humidity_2m"], 1),  # humidity
-                            "ws": round(h["wind_speed_10m"], 1),  # wind speed
-                            "wd": round(h["wind_direction_10m"], 1),  # wind direction
-                            "cc": round(h["cloud_cover"], 1),  # cloud cover
-                            "pr": round(h["pressure_msl"], 1)  # pressure
-                        } for h in data["token_details"]["world_conditions_on_mint"]["weather_data"]["hourly"]
-                    ]
-                }
+                "cp": _round(wc["co2_ppm"], 1),  # co2_ppm
+                "gt": _round(wc["global_temperature_anomaly_c"], 1),  # global temp
+                "ch": _round(wc["ch4_ppb"], 1),  # ch4_ppb
+                "ai": _round(wc["arctic_sea_ice_min_extent_million_km2"], 1),  # arctic ice
+                "sl": _round(wc["sea_level_mm_above_ref"], 1),  # sea level
+                "ni": wc["nasa_image"],  # nasa image
+                "pi": wc["planetary_image"],  # planetary image
+                "wd": build_hourly(times, *columns)  # weather data, hourly columns
             }
         }
     }
     
-    # Add achievements if present
-    if data["token_details"]["achievements"]:
-        optimized["t"]["ac"] = data["token_details"]["achievements"]
+    # Add achievements only if present
+    achievements = td["achievements"]
+    if achievements:
+        optimized["t"]["ac"] = achievements.as_list()
     
     return optimized
 
-def minify_file(file_path):
+def upgrade_minified(data):
+    """
+    Convert a file minified in an older, unversioned layout to the current
+    schema. Those files carry the input's metadata_version as "v" and store
+    hourly weather either as per-hour records under "wd": {"h": [...]} or
+    as column lists, with or without an empty "a"; "a" is dropped.
+    
+    Current-schema files that were merely re-serialized (pretty-printed, so
+    they fail `is_optimized`) are re-encoded as they are. Any other schema
+    version, e.g. one written by a newer release, is rejected.
+    """
+    version = data["v"]
+    if "mv" in data:
+        if version != MINIFIED_SCHEMA_VERSION:
+            raise ValueError(f"unsupported minified schema version {version!r}")
+        metadata_version = data["mv"]
+    elif isinstance(version, str):
+        # Unversioned: "v" is the input's metadata_version
+        metadata_version = version
+    else:
+        raise ValueError(f"unsupported minified schema version {version!r}")
+    
+    t = data["t"]
+    w = t["w"]
+    wd = w["wd"]
+    if "t" in wd:
+        # Column lists
+        times = wd["t"].as_list()
+        values = [wd[key].as_list() for key in HOURLY_KEYS]
+    else:
+        # Per-hour records
+        times = []
+        values = []
+        for h in wd["h"]:
+            times.append(h["t"])
+            values.append([h[key] for key in HOURLY_KEYS])
+        values = np.array(values, dtype=np.float64).reshape(-1, len(HOURLY_KEYS)).T
+    columns = hourly_columns(np.array(values, dtype=np.float64))
+    
+    c = t["c"]
+    upgraded = {
+        "v": MINIFIED_SCHEMA_VERSION,
+        "mv": metadata_version,
+        "t": {
+            "ts": t["ts"],
+            "sn": t["sn"],
+            "c": {"la": c["la"], "lo": c["lo"]},
+            "w": {
+                "cp": w["cp"],
+                "gt": w["gt"],
+                "ch": w["ch"],
+                "ai": w["ai"],
+                "sl": w["sl"],
+                "ni": w["ni"],
+                "pi": w["pi"],
+                "wd": build_hourly(times, *columns)
+            }
+        }
+    }
+    if "ac" in t:
+        upgraded["t"]["ac"] = t["ac"].as_list()
+    
+    return upgraded
+
+def read_file(file_path):
+    """
+    Read a single file. Small files are returned as bytes; files of at
+    least MMAP_THRESHOLD bytes as a read-only mmap that the parser reads
+    straight from the page cache, which the caller must close.
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        if os.fstat(fd).st_size >= MMAP_THRESHOLD:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        with open(fd, 'rb', closefd=False) as f:
+            return f.read()
+    finally:
+        os.close(fd)
+
+def replace_file(file_path, data):
+    """
+    Write `data` to `file_path` through a temporary file and os.replace, so a
+    crash never leaves a truncated file. The bytes go straight to a raw fd
+    with os.write, skipping the buffered file object.
+    """
+    tmp_path = file_path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, file_path)
+
+def looks_complete(raw):
+    """
+    Cheap check that a file's bytes can hold a whole JSON object: the first
+    byte is '{' and the last non-whitespace byte is '}'. Catches truncated
+    and empty files before any parse work is spent on them.
+    """
+    return raw[:1] == b'{' and raw[-64:].rstrip().endswith(b'}')
+
+def is_optimized(head):
+    """
+    Cheap check on the first bytes of a file for the compact optimized
+    structure written by `minify_file` in the current schema version.
+    Files minified in an older layout don't match and are rewritten.
+    """
+    return head.startswith(OPTIMIZED_PREFIX)
+
+def minify_file(file_path, pending_read=None, manifest_rows=None):
     """
     Minify a single JSON file by removing unnecessary whitespace and optimizing structure.
+    `pending_read` is an optional future already reading the file's bytes.
+    If `manifest_rows` is given, the written file's manifest row is appended to it.
+    With a worker compressor, a zstd copy is also written next to the file as
+    `file_path + '.zst'`, compressed while the serialized bytes are at hand.
     """
     try:
         # Read the file
-        with open(file_path, 'r') as f:
-            data = json.load(f)
+        raw = pending_read.result() if pending_read is not None else read_file(file_path)
+        try:
+            # Skip truncated or corrupt files without parsing them
+            if not looks_complete(raw):
+                print(f"Skipping malformed file {file_path}")
+                return False
+            
+            # Files already in the optimized form need no parse or rewrite
+            if is_optimized(raw[:64]):
+                optimized_data = None
+                # Still compress it below if it has no zstd copy yet
+                if worker_state.compressor is not None and not os.path.exists(file_path + '.zst'):
+                    data_bytes = bytes(raw)
+                else:
+                    data_bytes = None
+            else:
+                # Optimize the data structure; files already minified, in an
+                # older layout or re-serialized, are re-encoded instead
+                doc = worker_state.parser.parse(raw)
+                if "token_details" in doc:
+                    optimized_data = optimize_metadata(doc)
+                else:
+                    optimized_data = upgrade_minified(doc)
+                data_bytes = orjson.dumps(optimized_data, option=orjson.OPT_SERIALIZE_NUMPY)
+        finally:
+            if isinstance(raw, mmap.mmap):
+                raw.close()
+        
+        # Write back minified (orjson output is compact by default)
+        if optimized_data is not None:
+            replace_file(file_path, data_bytes)
         
-        # Optimize the data structure
-        optimized_data = optimize_metadata(data)
+        if worker_state.compressor is not None and data_bytes is not None:
+            replace_file(file_path + '.zst', worker_state.compressor.compress(data_bytes))
         
-        # Write back minified
-        with open(file_path, 'w') as f:
-            json.dump(optimized_data, f, separators=(',', ':'))
+        if manifest_rows is not None:
+            st = os.stat(file_path)
+            manifest_rows.append((file_path, st.st_mtime_ns, st.st_size, MINIFIED_SCHEMA_VERSION))
         
         return True
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         return False
 
+def unchanged_files(file_paths):
+    """
+    Return the subset of `file_paths` whose mtime and size still match the
+    manifest, i.e. files already minified by a previous run in the current
+    schema version.
+    """
+    placeholders = ",".join("?" * len(file_paths))
+    recorded = {
+        path: (mtime_ns, size)
+        for path, mtime_ns, size in worker_state.manifest.execute(
+            f"SELECT path, mtime_ns, size FROM minified WHERE path IN ({placeholders}) AND schema = ?",
+            (*file_paths, MINIFIED_SCHEMA_VERSION),
+        )
+    }
+    unchanged = set()
+    for file_path in recorded:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            # Gone or unreadable since the scan; `minify_file` reports it
+            continue
+        if recorded[file_path] == (st.st_mtime_ns, st.st_size):
+            unchanged.add(file_path)
+    return unchanged
+
 def process_batch(file_paths):
     """
-    Process a batch of files.
+    Process a batch of files, reading up to READ_AHEAD files ahead on the
+    worker's read pool so disk reads overlap with parsing and optimizing.
+    Without a read pool (--io-bound) each file is read inline.
+    Files the manifest shows as already minified are skipped.
     """
-    success_count = 0
-    for file_path in file_paths:
-        if minify_file(file_path):
-            success_count += 1
+    unchanged = unchanged_files(file_paths)
+    if worker_state.compressor is not None:
+        # Files minified by a run without --zstd still need their zstd copy
+        unchanged = {path for path in unchanged if os.path.exists(path + '.zst')}
+    success_count = len(unchanged)
+    manifest_rows = []
+    paths = (file_path for file_path in file_paths if file_path not in unchanged)
+    io_pool = worker_state.read_pool
+    if io_pool is None:
+        # Worker threads are already many readers; adding read-ahead on top
+        # would only multiply the reads queued on the disk
+        for file_path in paths:
+            if minify_file(file_path, None, manifest_rows):
+                success_count += 1
+    else:
+        reads = deque(
+            (file_path, io_pool.submit(read_file, file_path))
+            for file_path in itertools.islice(paths, READ_AHEAD)
+        )
+        while reads:
+            file_path, pending_read = reads.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                reads.append((next_path, io_pool.submit(read_file, next_path)))
+            if minify_file(file_path, pending_read, manifest_rows):
+                success_count += 1
+    
+    # Record the whole batch in one short transaction
+    with worker_state.manifest:
+        worker_state.manifest.executemany(
+            "INSERT OR REPLACE INTO minified (path, mtime_ns, size, schema) VALUES (?, ?, ?, ?)", manifest_rows
+        )
     return success_count
 
+def iter_files(directory):
+    """
+    Yield the path of every .txt file in `directory` without building a
+    list of all names first.
+    """
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith('.txt') and entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+def iter_batches(iterable, batch_size):
+    """
+    Yield lists of up to `batch_size` items from `iterable`.
+    """
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, batch_size)):
+        yield batch
+
 def main():
+    arg_parser = argparse.ArgumentParser(description="Minify Legado metadata files in place.")
+    arg_parser.add_argument(
+        "--io-bound",
+        action="store_true",
+        help="use a thread pool instead of processes, for slow disks or network storage",
+    )
+    arg_parser.add_argument(
+        "--zstd",
+        action="store_true",
+        help="also write a zstd-compressed copy of each minified file (<name>.txt.zst)",
+    )
+    args = arg_parser.parse_args()
+    
     # Directory containing the metadata files
     input_dir = "metadata_files"
     
-    # Get all .txt files
-    files = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.txt')]
-    total_files = len(files)
+    # Manifest of files already minified, so re-runs skip them
+    manifest_path = os.path.join(input_dir, "minified.sqlite")
+    connect_manifest(manifest_path).close()
     
-    # Number of processes to use (use all available CPU cores)
-    num_processes = multiprocessing.cpu_count()
+    # Count the .txt files up front for the progress bar and batch size; the
+    # file list itself is streamed from a second scan, and the final counts
+    # come from the batches actually submitted
+    expected_files = sum(1 for _ in iter_files(input_dir))
     
-    # Split files into batches for parallel processing
-    batch_size = (total_files + num_processes - 1) // num_processes
-    file_batches = [files[i:i + batch_size] for i in range(0, total_files, batch_size)]
+    # Number of processes to use (use all available CPU cores). When the run
+    # is I/O-bound, threads waiting on the disk are cheaper than processes,
+    # and orjson/simdjson do their work in C; each thread then reads its
+    # files inline, so at most one read per worker is in flight
+    num_processes = multiprocessing.cpu_count()
+    if args.io_bound:
+        executor_class = ThreadPoolExecutor
+        num_workers = min(32, num_processes * 4)
+    else:
+        executor_class = ProcessPoolExecutor
+        num_workers = num_processes
     
-    # Create a pool of processes
-    pool = multiprocessing.Pool(processes=num_processes)
+    # Split files into many small batches so idle workers keep pulling work
+    # instead of waiting on one straggling process-sized batch
+    batch_size = max(1, min(MAX_BATCH_SIZE, expected_files // (num_workers * 8)))
+    file_batches = iter_batches(iter_files(input_dir), batch_size)
     
     # Initialize progress bar
-    pbar = tqdm(total=total_files, desc="Minifying files")
+    pbar = tqdm(total=expected_files, desc="Minifying files", mininterval=0.25)
     
-    # Process batches in parallel
+    # Process batches in parallel, each worker setting up its parser once.
+    # Only BATCHES_IN_FLIGHT batches per worker are submitted at a time
+    # (Executor.map would consume the whole file list up front); progress
+    # is pushed to tqdm in chunks rather than per batch
+    total_files = 0
     success_count = 0
-    for batch_success in pool.imap_unordered(process_batch, file_batches):
-        success_count += batch_success
-        pbar.update(batch_success)
+    pending_progress = 0
+    last_update = time.monotonic()
+    max_in_flight = num_workers * BATCHES_IN_FLIGHT
+    with executor_class(
+        max_workers=num_workers, initializer=init_worker, initargs=(manifest_path, args.zstd, not args.io_bound)
+    ) as executor:
+        pending = set()
+        while True:
+            for batch in itertools.islice(file_batches, max_in_flight - len(pending)):
+                pending.add(executor.submit(process_batch, batch))
+                total_files += len(batch)
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch_success = future.result()
+                success_count += batch_success
+                pending_progress += batch_success
+            now = time.monotonic()
+            if pending_progress >= PROGRESS_CHUNK or now - last_update >= 0.25:
+                pbar.update(pending_progress)
+                pending_progress = 0
+                last_update = now
     
-    # Close the pool
-    pool.close()
-    pool.join()
+    # The directory may have changed since it was counted
+    pbar.total = total_files
+    pbar.update(pending_progress)
     pbar.close()
     
     print(f"\nMinification complete!")